@@ -4,152 +4,501 @@
 # mtj@mtjones.com
 # April 12th, 2025
 
-from openai import OpenAI
 import os
 import sys
+import re
+import ast
+import json
+import mmap
+import types
+import textwrap
+import time
+import hashlib
 import logging
 import argparse
-from typing import Optional
+import functools
+from typing import Optional, TextIO
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard as zstd
+    _ZSTD_ERRORS = ( zstd.ZstdError, )
+except ImportError:
+    zstd = None
+    _ZSTD_ERRORS = ( )
+
+MODEL = "gpt-4o"
+MODEL_CONTEXT_TOKENS = 128000
+RESPONSE_TOKEN_RESERVE = 4096
+CHUNK_TOKENS = 100000
+# Deterministic sampling, so cached responses match what the API would return.
+DEFAULT_TEMPERATURE = 0.0
+SEED = 42
+MAX_CONCURRENT_REQUESTS = 8
+MAX_REQUESTS_PER_MINUTE = 500
+MAX_TOKENS_PER_MINUTE = 30000
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 1.0
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_POLL_SECONDS = 30
+BATCH_FINAL_STATES = ( "completed", "failed", "expired", "cancelled" )
+CACHE_DIR = os.path.join( os.path.expanduser( "~" ), ".cache", "codeaid" )
+DEFAULT_CACHE_TTL = 1800
+CACHE_COMPRESSION_LEVEL = 3
+MMAP_THRESHOLD = 1024 * 1024
+EMBEDDING_MODEL = "text-embedding-3-small"
+# The embedding model accepts 8191 tokens; the margin covers counting with the chat model's encoding.
+EMBEDDING_MAX_TOKENS = 7500
+DEFAULT_SEMANTIC_THRESHOLD = 0.95
+TASK_HEADER = "### Task {index}"
+TASK_HEADER_PATTERN = re.compile( r"^### Task (\d+)\s*$", re.MULTILINE )
+# Goals whose response rewrites the source, so the chunk responses of an oversize file are joined rather than merged.
+REWRITE_GOALS = frozenset( ( "document", "translate", "cleanup", "ut" ) )
+# Tokens allowed for each "### Part N" header of a reduce prompt.
+PART_HEADER_TOKENS = 8
+
+
+@functools.lru_cache( maxsize = None )
+def _get_encoding( ):
+    """Returns the tiktoken encoding for the model, or None if tiktoken is unavailable."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.encoding_for_model( MODEL )
+
+
+def count_tokens( text: str ) -> int:
+    """Counts the model tokens in the text, estimating from its length without tiktoken."""
+    encoding = _get_encoding( )
+    if encoding is None:
+        return len( text ) // 4 + 1
+    # Sources may legitimately contain special-token text such as <|endoftext|>.
+    return len( encoding.encode( text, disallowed_special = ( ) ) )
+
+
+def json_dumps( value ) -> bytes:
+    """Serializes the value to UTF-8 JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps( value )
+    return json.dumps( value, ensure_ascii = False ).encode( "utf-8" )
+
+
+def json_loads( data ):
+    """Parses JSON from bytes or str, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads( data )
+    return json.loads( data )
+
+
+def cleandoc( text: str ) -> str:
+    """Removes the indentation of a triple-quoted string, as inspect.cleandoc does, without importing inspect."""
+    first, _, rest = text.partition( "\n" )
+    return ( first.lstrip( ) + "\n" + textwrap.dedent( rest ) ).strip( "\n" )
+
+
+# A prompt as ( system, user ): the static goal instructions and the source under analysis.
+PromptMessage = tuple[str, str]
+
+# System prompt for merging the per-chunk analyses of an oversize source file.
+REDUCE_PROMPT = cleandoc(
+    """The following are analyses of consecutive parts of a single source 
+    file, each produced with the instructions below. Merge them into one 
+    response for the whole file, as if it had been analyzed at once: keep 
+    the order of the parts, remove repetition, and follow the original 
+    instructions for the form of the response.
+
+    Original instructions:
+    """
+)
+
+# Predefined prompts for various goals, built once at import.
+_PROMPTS = types.MappingProxyType( {
+    "summarize": cleandoc(
+       """Act as a programming assistant. After examining the provided 
+       source code, identify the language in which it is written, then 
+       give a concise, one-paragraph summary of its functionality. 
+       Include any notable or interesting elements a programmer would 
+       find useful or appreciate, but keep your explanation streamlined 
+       and to the point.
+       """
+    ),
+
+    "defects": cleandoc(
+        """Act as an expert software debugger. After examining the 
+        provided source code, briefly summarize any possible defects 
+        you find, focusing strictly on potential errors without including 
+        unrelated discussion.
+        """
+    ),
+
+    "security": cleandoc(
+        """Act as a software security expert. Examine the provided source 
+        code, identify any potential vulnerabilities, and offer concise 
+        recommendations to improve its security.
+        """
+    ),
+
+    "optimize": cleandoc(
+        """Act as a software optimization expert. Evaluate the provided 
+        source code and recommend performance improvements. Include any 
+        best practices, plus language-specific techniques that can 
+        significantly enhance efficiency.
+        """
+    ),
+
+    "refactor": cleandoc(
+        """Act as a software refactoring expert. Analyze the provided 
+        source code and propose improvements to maintainability, 
+        readability, modularization, naming, and decomposition. Offer 
+        reorganizations, style enhancements, and language-specific 
+        techniques (e.g., creating classes) that clarify and structure 
+        the code more effectively.
+        """
+    ),
+
+    "document": cleandoc(
+        """Act as a software documentation expert. After examining the 
+        provided source code, generate comprehensive documentation, 
+        inline comments, or markdown—summarizing the entire file and 
+        each module in a clear, concise manner.
+        """
+    ),
+
+    "complexity": cleandoc(
+        """Act as an expert software engineer dedicated to reducing 
+        complexity.  Review the provided source code, evaluate the 
+        complexity of its functions and modules, and highlight any 
+        excessively tangled or overly complex areas that warrant 
+        refactoring. Focus on modularization, maintainability, and 
+        readability enhancements.
+        """
+    ),
+
+    "naming": cleandoc(
+        """Act as an expert software engineer prioritizing readability. 
+        Examine the source code’s variable and function naming, 
+        highlighting any non-descriptive names and recommending more 
+        descriptive alternatives. List only necessary changes, keeping 
+        the response concise.
+        """
+    ),
+
+    "translate": cleandoc(
+        """Act as a software translation expert. Review the provided 
+        source code and rewrite it in XXX language, preserving the 
+        original functionality and logic.
+        """
+    ),
+
+    "cleanup": cleandoc(
+        """Your role is a software cleanup specialist.  Your goal is 
+        to take the software provided in the context below and convert 
+        it into PEP-8 style.  Maintain all functionality, just refine 
+        into PEP-8.
+        """
+    ),
+
+    "todo": cleandoc(
+        """You are an agile story writing expert.  Your goal is to 
+        find each TODO in the source code and write an agile story for 
+        it.  Please keep the stories focused on the task at hand 
+        (using the TODO text and surrounding code as a guide).
+        """
+    ),
+
+    "ut": cleandoc(
+        """You are a test development expert.  Your goal is to analyze 
+        the source code and develop unit-tests using the unittest module 
+        to validate the code for quality improvement for future changes.
+        """
+    )
+} )
+
 
 class PromptManager:
     """Manages different prompt templates for various code analysis goals."""
 
-    def __init__(self):
-        """Initializes the PromptManager with predefined prompts."""
-        self.prompts = self._initialize_prompts( )
-        self._goals_list = ', '.join( self.prompts.keys( ) )
-
-    def _initialize_prompts( self ) -> dict[str, str]:
-        """Sets up predefined prompts for various goals."""
-        return {
-            "summarize": (
-               """Act as a programming assistant. After examining the provided 
-               source code, identify the language in which it is written, then 
-               give a concise, one-paragraph summary of its functionality. 
-               Include any notable or interesting elements a programmer would 
-               find useful or appreciate, but keep your explanation streamlined 
-               and to the point.
-               """
-            ),
-
-            "defects": (
-                """Act as an expert software debugger. After examining the 
-                provided source code, briefly summarize any possible defects 
-                you find, focusing strictly on potential errors without including 
-                unrelated discussion.
-                """
-            ),
-
-            "security": (
-                """Act as a software security expert. Examine the provided source 
-                code, identify any potential vulnerabilities, and offer concise 
-                recommendations to improve its security.
-                """
-            ),
-
-            "optimize": (
-                """Act as a software optimization expert. Evaluate the provided 
-                source code and recommend performance improvements. Include any 
-                best practices, plus language-specific techniques that can 
-                significantly enhance efficiency.
-                """
-            ),
-
-            "refactor": (
-                """Act as a software refactoring expert. Analyze the provided 
-                source code and propose improvements to maintainability, 
-                readability, modularization, naming, and decomposition. Offer 
-                reorganizations, style enhancements, and language-specific 
-                techniques (e.g., creating classes) that clarify and structure 
-                the code more effectively.
-                """
-            ),
-
-            "document": (
-                """Act as a software documentation expert. After examining the 
-                provided source code, generate comprehensive documentation, 
-                inline comments, or markdown—summarizing the entire file and 
-                each module in a clear, concise manner.
-                """
-            ),
-
-            "complexity": (
-                """Act as an expert software engineer dedicated to reducing 
-                complexity.  Review the provided source code, evaluate the 
-                complexity of its functions and modules, and highlight any 
-                excessively tangled or overly complex areas that warrant 
-                refactoring. Focus on modularization, maintainability, and 
-                readability enhancements.
-                """
-            ),
-
-            "naming": (
-                """Act as an expert software engineer prioritizing readability. 
-                Examine the source code’s variable and function naming, 
-                highlighting any non-descriptive names and recommending more 
-                descriptive alternatives. List only necessary changes, keeping 
-                the response concise.
-                """
-            ),
-
-            "translate": (
-                """Act as a software translation expert. Review the provided 
-                source code and rewrite it in XXX language, preserving the 
-                original functionality and logic.
-                """
-            ),
-
-            "cleanup": (
-                """Your role is a software cleanup specialist.  Your goal is 
-                to take the software provided in the context below and convert 
-                it into PEP-8 style.  Maintain all functionality, just refine 
-                into PEP-8.
-                """
-            ),
-
-            "todo": (
-                """You are an agile story writing expert.  Your goal is to 
-                find each TODO in the source code and write an agile story for 
-                it.  Please keep the stories focused on the task at hand 
-                (using the TODO text and surrounding code as a guide).
-                """
-            ),
-
-            "ut": (
-                """You are a test development expert.  Your goal is to analyze 
-                the source code and develop unit-tests using the unittest module 
-                to validate the code for quality improvement for future changes.
-                """
-            )
-        }
+    prompts = _PROMPTS
 
     def get_prompt_by_goal( self, goal: str ) -> Optional[str]:
         """Retrieves the prompt for the specific goal."""
-        return self.prompts.get( goal )
+        return _PROMPTS.get( goal )
 
+    @functools.cached_property
     def goals(self) -> str:
         """Returns a list of available goals as a comma-separated string."""
-        return self._goals_list
+        return ', '.join( self.prompts )
+
+
+class ResponseCache():
+    """Disk-backed cache of responses keyed by request parameters and source hash.
+
+    Entries are zstd-compressed when the zstandard package is installed.
+    """
+
+    def __init__( self, directory: str = CACHE_DIR, ttl: float = DEFAULT_CACHE_TTL, enabled: bool = True ):
+        """Initializes the cache; entries older than ttl seconds are treated as misses."""
+        self.directory = directory
+        self.ttl = ttl
+        self.enabled = enabled
+        self._compressor = zstd.ZstdCompressor( level = CACHE_COMPRESSION_LEVEL ) if zstd else None
+        self._decompressor = zstd.ZstdDecompressor( ) if zstd else None
+
+    @staticmethod
+    def make_key( request_body: dict, source_digest: str ) -> str:
+        """Returns the cache key for sending a source, given its digest, in the request body.
+
+        The body is the request with an empty user message, so the key covers
+        the system prompt text, message layout, model and sampling parameters.
+        """
+        material = json.dumps( request_body, sort_keys = True ) + "\0" + source_digest
+        return hashlib.sha256( material.encode( "utf-8" ) ).hexdigest( )
+
+    def _path( self, key: str ) -> str:
+        """Returns the file path of the cache entry for the key."""
+        return os.path.join( self.directory, f"{key}.zst" if self._compressor else f"{key}.txt" )
+
+    def get( self, key: str ) -> Optional[str]:
+        """Returns the cached response for the key, or None if missing, expired or unreadable."""
+        path = self._path( key )
+        try:
+            if time.time( ) - os.stat( path ).st_mtime > self.ttl:
+                return None
+            with open( path, "rb" ) as file:
+                data = file.read( )
+            if self._decompressor:
+                data = self._decompressor.decompress( data )
+            return data.decode( "utf-8" )
+        except ( OSError, UnicodeDecodeError, *_ZSTD_ERRORS ):
+            return None
+
+    def put( self, key: str, response: str ) -> None:
+        """Stores the response for the key, replacing any existing entry."""
+        path = self._path( key )
+        try:
+            os.makedirs( self.directory, exist_ok = True )
+            temporary = f"{path}.{os.getpid( )}.tmp"
+            data = response.encode( "utf-8" )
+            if self._compressor:
+                data = self._compressor.compress( data )
+            with open( temporary, "wb" ) as file:
+                file.write( data )
+            os.replace( temporary, path )
+        except OSError as error:
+            logging.error( f"Unable to write cache entry {path}: {error}" )
+
+
+class SemanticCache():
+    """Embedding-based cache that reuses responses for near-duplicate prompts.
+
+    Entries are kept in a FAISS inner-product index of normalized embeddings,
+    so search scores are cosine similarities. Each system prompt gets its own
+    index, since a prompt is dominated by its source and would otherwise match
+    the same file analyzed for a different goal. Entries expire after the TTL,
+    like those of the ResponseCache.
+    """
+
+    def __init__( self, client, system_prompt: str, threshold: float = DEFAULT_SEMANTIC_THRESHOLD,
+                  ttl: float = DEFAULT_CACHE_TTL, directory: str = CACHE_DIR ):
+        """Initializes the cache, loading the unexpired entries saved for the system prompt."""
+        import faiss
+        import numpy
+
+        self._faiss = faiss
+        self._numpy = numpy
+        self.client = client
+        self.threshold = threshold
+        self.ttl = ttl
+        scope = hashlib.sha256( "\0".join( ( MODEL, EMBEDDING_MODEL, system_prompt ) ).encode( "utf-8" ) ).hexdigest( )
+        self.index_path = os.path.join( directory, f"semantic-{scope}.index" )
+        self.responses_path = os.path.join( directory, f"semantic-{scope}.json" )
+        self.index = None
+        # Parallel to the index rows: { "response": str, "created": epoch seconds }.
+        self.entries: list[dict] = [ ]
+        self._dirty = False
+
+        if os.path.exists( self.index_path ) and os.path.exists( self.responses_path ):
+            self._load( )
+
+    def _is_fresh( self, entry ) -> bool:
+        """Returns True if the entry is well-formed and younger than the TTL."""
+        return isinstance( entry, dict ) and time.time( ) - entry.get( "created", 0 ) <= self.ttl
+
+    def _load( self ) -> None:
+        """Loads the saved index and entries, dropping the expired ones.
+
+        Unreadable files (e.g. truncated by an interrupted save) leave the cache empty.
+        """
+        try:
+            index = self._faiss.read_index( self.index_path )
+            with open( self.responses_path, "rb" ) as file:
+                entries = json_loads( file.read( ) )
+        except ( RuntimeError, ValueError, OSError ) as error:
+            logging.error( f"Unable to read semantic cache {self.index_path}, starting empty: {error}" )
+            self._dirty = True
+            return
+        if not isinstance( entries, list ) or index.ntotal != len( entries ):
+            # Out of step (e.g. an interrupted save); start afresh.
+            self._dirty = True
+            return
+
+        keep = [ row for row, entry in enumerate( entries ) if self._is_fresh( entry ) ]
+        if len( keep ) == len( entries ):
+            self.index, self.entries = index, entries
+            return
+
+        self._dirty = True
+        if keep:
+            self.index = self._faiss.IndexFlatIP( index.d )
+            self.index.add( index.reconstruct_n( 0, index.ntotal )[keep] )
+            self.entries = [ entries[row] for row in keep ]
+
+    async def embed( self, message: PromptMessage ):
+        """Returns the normalized embedding of the message, or None if it cannot be embedded."""
+        from openai import APIError
+
+        # The system instructions are fixed per index, so only the source is embedded.
+        if count_tokens( message[1] ) > EMBEDDING_MAX_TOKENS:
+            return None
+        try:
+            result = await self.client.embeddings.create( model = EMBEDDING_MODEL, input = message[1] )
+        except APIError as error:
+            logging.error( f"Unable to embed prompt for semantic cache: {error}" )
+            return None
+        vector = self._numpy.array( [ result.data[0].embedding ], dtype = "float32" )
+        self._faiss.normalize_L2( vector )
+        return vector
+
+    def lookup( self, vector ) -> Optional[str]:
+        """Returns the response of the most similar entry if it is fresh and above the threshold."""
+        if self.index is None or self.index.ntotal == 0:
+            return None
+        scores, ids = self.index.search( vector, 1 )
+        row = ids[0][0]
+        if row >= 0 and scores[0][0] > self.threshold and self._is_fresh( self.entries[row] ):
+            return self.entries[row]["response"]
+        return None
+
+    def add( self, vector, response: str ) -> None:
+        """Adds the response under the embedding."""
+        if self.index is None:
+            self.index = self._faiss.IndexFlatIP( vector.shape[1] )
+        self.index.add( vector )
+        self.entries.append( { "response": response, "created": time.time( ) } )
+        self._dirty = True
+
+    def save( self ) -> None:
+        """Writes the index and entries to disk if anything changed."""
+        if not self._dirty:
+            return
+        try:
+            if self.index is None:
+                for path in ( self.index_path, self.responses_path ):
+                    if os.path.exists( path ):
+                        os.remove( path )
+                self._dirty = False
+                return
+            os.makedirs( os.path.dirname( self.index_path ), exist_ok = True )
+            # Each file is replaced whole, so readers never see a partial write.
+            temporary = f"{self.index_path}.{os.getpid( )}.tmp"
+            self._faiss.write_index( self.index, temporary )
+            os.replace( temporary, self.index_path )
+            temporary = f"{self.responses_path}.{os.getpid( )}.tmp"
+            with open( temporary, "wb" ) as file:
+                file.write( json_dumps( self.entries ) )
+            os.replace( temporary, self.responses_path )
+            self._dirty = False
+        except ( OSError, RuntimeError ) as error:
+            logging.error( f"Unable to write semantic cache {self.index_path}: {error}" )
+
+
+def write_response( output: Optional[TextIO], response: Optional[str] ) -> None:
+    """Writes a complete response to the output, if streaming to one."""
+    if output is not None and response:
+        output.write( response + "\n" )
+        output.flush( )
+
+
+def cached_response( execute_prompt ):
+    """Decorates execute_prompt to consult the client's caches when given a cache key.
+
+    Cached responses are written to the output in one piece when streaming.
+    Pass semantic=False for prompts whose user message is not a source file.
+    """
+    @functools.wraps( execute_prompt )
+    async def wrapper( self, message: PromptMessage, cache_key: Optional[str] = None,
+                       output: Optional[TextIO] = None, semantic: bool = True ) -> str:
+        if cache_key is None or not self.cache.enabled:
+            return await execute_prompt( self, message, output )
+
+        response = self.cache.get( cache_key )
+        if response is not None:
+            write_response( output, response )
+            return response
+
+        vector = None
+        if self.semantic_cache is not None and semantic:
+            vector = await self.semantic_cache.embed( message )
+            if vector is not None:
+                response = self.semantic_cache.lookup( vector )
+                write_response( output, response )
+
+        if response is None:
+            response = await execute_prompt( self, message, output )
+            if response and vector is not None:
+                self.semantic_cache.add( vector, response )
+
+        if response:
+            self.cache.put( cache_key, response )
+        return response
+
+    return wrapper
 
 
 class OpenAIClient():
     """Client for interaction with OpenAI API."""
 
-    def __init__(self):
-        """Initializes the LLMClient with the OpenAI API key."""
-        self.openai_key = self._get_openai_key( )
+    def __init__( self, openai_key: str, cache: Optional[ResponseCache] = None,
+                  temperature: float = DEFAULT_TEMPERATURE,
+                  max_requests_per_minute: float = MAX_REQUESTS_PER_MINUTE,
+                  max_tokens_per_minute: float = MAX_TOKENS_PER_MINUTE ):
+        """Initializes the LLMClient with the OpenAI API key and the account's rate limits."""
+        # openai is imported lazily; it is slow to load and not needed for usage errors.
+        from openai import AsyncOpenAI
 
-    @staticmethod
-    def _get_openai_key( ) -> str:
-        """Get the OPENAI Key from the environment variables."""
-        openai_key = os.environ.get( 'OPENAI_KEY', None )
-        if openai_key is None:
-            logging.error( "OPENAI_KEY is not set\n" )
-            sys.exit(1)
-        return openai_key
-
-    def compose_prompt_message( self, goal:str, context:str, prompt_manager: PromptManager, target:str ) -> Optional[str]:
-        """Creates the complete prompt message based on the goal and context."""
+        self.openai_key = openai_key
+        self.cache = cache if cache is not None else ResponseCache( enabled = False )
+        self.semantic_cache: Optional[SemanticCache] = None
+        self.temperature = temperature
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        # One client, and so one keep-alive connection pool, serves every request of the run.
+        # The SDK retries transient failures; the ParallelProcessor backs off on persistent 429s.
+        self.client = AsyncOpenAI( api_key = self.openai_key )
+
+    @property
+    def max_request_tokens( self ) -> int:
+        """Returns the largest prompt that fits both the context window and the token rate limit.
+
+        OpenAI rejects a request larger than the tokens-per-minute limit outright.
+        """
+        return int( min( MODEL_CONTEXT_TOKENS - RESPONSE_TOKEN_RESERVE, self.max_tokens_per_minute ) )
+
+    async def close( self ) -> None:
+        """Closes the connection pool of the underlying client."""
+        await self.client.close( )
+
+    def compose_prompt_message( self, goal:str, context:str, prompt_manager: PromptManager, target:str ) -> Optional[PromptMessage]:
+        """Creates the ( system, user ) prompt message based on the goal and context.
+
+        The goal instructions go in the system message ahead of the source, so
+        the stable prefix can be reused by the provider's prompt caching.
+        """
         prompt = prompt_manager.get_prompt_by_goal(goal)
         if prompt is None:
             logging.error(f"Goal {goal} is not recognized.\n\n")
@@ -158,36 +507,414 @@ class OpenAIClient():
         if target is not None and goal == 'translate':
             prompt = prompt.replace("XXX", target)
 
-        return prompt + context
+        return prompt, context
 
 
-    def execute_prompt( self, message: str ) -> str:
-        """Executes the prompt against the OpenAI API and returns the response."""
-        client = OpenAI( api_key = self.openai_key )
+    def build_request_body( self, message: PromptMessage ) -> dict:
+        """Builds the chat completion request body for the message."""
+        system, user = message
+        return {
+            "messages": [ { "role": "system", "content": system, },
+                          { "role": "user", "content": user, } ],
+            "model": MODEL,
+            "temperature": self.temperature,
+            "seed": SEED,
+        }
 
-        chat_completion = client.chat.completions.create(
-            messages = [ { "role": "user", "content": message, } ],
-            model="gpt-4o",
-        )
+    @cached_response
+    async def execute_prompt( self, message: PromptMessage, output: Optional[TextIO] = None ) -> str:
+        """Executes the prompt against the OpenAI API and returns the response.
 
-        return chat_completion.choices[0].message.content.strip()
+        When an output is given, the response is streamed to it as it arrives.
+        """
+        request = self.build_request_body( message )
+        if output is None:
+            chat_completion = await self.client.chat.completions.create( **request )
+            choice = chat_completion.choices[0]
+            # Refusals and content filters come back without any content.
+            if choice.message.content is None:
+                logging.error( f"Response has no content (finish reason: {choice.finish_reason})." )
+                return ""
+            return choice.message.content.strip( )
 
+        parts = [ ]
+        async for chunk in await self.client.chat.completions.create( **request, stream = True ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append( chunk.choices[0].delta.content )
+                output.write( parts[-1] )
+                output.flush( )
+        output.write( "\n" )
+        return "".join( parts ).strip( )
 
-def read_source_file( filename: str) -> Optional[str]:
-    """Reads the content of the source file and returns to the caller."""
+    @staticmethod
+    def compose_batched_message( messages: list[PromptMessage] ) -> PromptMessage:
+        """Combines several prompt messages into one request with numbered task headers."""
+        instructions = ( f"Complete each of the following {len( messages )} independent tasks. "
+                         "Begin each answer with its task header on a line by itself, "
+                         f"exactly as given (e.g. \"{TASK_HEADER.format( index = 1 )}\")." )
+        systems = { system for system, _ in messages }
+        if len( systems ) == 1:
+            # Shared instructions are stated once, ahead of the per-task sources.
+            system = f"{systems.pop( )}\n\n{instructions}"
+            tasks = [ user for _, user in messages ]
+        else:
+            system = instructions
+            tasks = [ f"{task_system}\n\n{user}" for task_system, user in messages ]
+
+        user = "\n\n".join( f"{TASK_HEADER.format( index = index )}\n{task}"
+                             for index, task in enumerate( tasks, start = 1 ) )
+        return system, user
+
+    @staticmethod
+    def split_batched_response( response: str, count: int ) -> list[Optional[str]]:
+        """Splits a batched response back into per-task answers by task header."""
+        answers: list[Optional[str]] = [ None ] * count
+        headers = list( TASK_HEADER_PATTERN.finditer( response ) )
+        for header, following in zip( headers, headers[1:] + [ None ] ):
+            index = int( header.group( 1 ) ) - 1
+            end = following.start( ) if following else len( response )
+            if 0 <= index < count:
+                answers[index] = response[header.end( ):end].strip( )
+        return answers
+
+    @staticmethod
+    def compose_reduce_message( system: str, analyses: list[str] ) -> PromptMessage:
+        """Creates the prompt message that merges per-chunk analyses made with the system prompt."""
+        parts = [ f"### Part {index}\n{analysis}"
+                  for index, analysis in enumerate( analyses, start = 1 ) ]
+        return f"{REDUCE_PROMPT}\n{system}", "\n\n".join( parts )
+
+
+class ParallelProcessor():
+    """Dispatches prompts concurrently while pacing them to the API rate limits."""
+
+    def __init__( self, llm_client: OpenAIClient,
+                  max_requests_per_minute: Optional[float] = None,
+                  max_tokens_per_minute: Optional[float] = None,
+                  num_workers: int = MAX_CONCURRENT_REQUESTS,
+                  max_attempts: int = MAX_ATTEMPTS,
+                  output: Optional[TextIO] = None,
+                  use_semantic_cache: bool = True ):
+        """Initializes the processor with full request and token capacity.
+
+        The rate limits default to those configured on the client.
+        If an output is given, responses are streamed to it; use this only
+        for a single prompt, as concurrent streams would interleave.
+        use_semantic_cache=False skips the semantic cache for these prompts.
+        """
+        import asyncio
+
+        self.llm_client = llm_client
+        self.output = output
+        self.use_semantic_cache = use_semantic_cache
+        self.max_requests_per_minute = max_requests_per_minute or llm_client.max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute or llm_client.max_tokens_per_minute
+        self.num_workers = num_workers
+        self.max_attempts = max_attempts
+        self.available_request_capacity = float( self.max_requests_per_minute )
+        self.available_token_capacity = float( self.max_tokens_per_minute )
+        self._last_update = time.monotonic( )
+        self._capacity_lock = asyncio.Lock( )
+
+    @staticmethod
+    def estimate_tokens( message: PromptMessage ) -> int:
+        """Estimates the number of prompt tokens consumed by the message."""
+        return sum( count_tokens( part ) for part in message )
+
+    def _refill_capacity( self ) -> None:
+        """Restores request and token capacity in proportion to the elapsed time."""
+        now = time.monotonic( )
+        elapsed = now - self._last_update
+        self._last_update = now
+        self.available_request_capacity = min( self.max_requests_per_minute,
+            self.available_request_capacity + elapsed * self.max_requests_per_minute / 60.0 )
+        self.available_token_capacity = min( self.max_tokens_per_minute,
+            self.available_token_capacity + elapsed * self.max_tokens_per_minute / 60.0 )
+
+    async def _acquire_capacity( self, tokens: int ) -> None:
+        """Waits until there is budget for one request of the given size, then consumes it."""
+        import asyncio
+
+        # A single oversize request would otherwise never fit in the bucket.
+        tokens = min( tokens, self.max_tokens_per_minute )
+        async with self._capacity_lock:
+            while True:
+                self._refill_capacity( )
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= tokens
+                    return
+                await asyncio.sleep( 0.05 )
+
+    async def _worker( self, queue: "asyncio.Queue", results: list[Optional[str]] ) -> None:
+        """Pulls prompts off the queue and executes them as capacity allows."""
+        import asyncio
+        from openai import RateLimitError, APIError
+
+        while True:
+            index, message, cache_key, tokens, attempt = await queue.get( )
+            try:
+                await self._acquire_capacity( tokens )
+                results[index] = await self.llm_client.execute_prompt( message, cache_key = cache_key,
+                                                                       output = self.output,
+                                                                       semantic = self.use_semantic_cache )
+            except RateLimitError:
+                if tokens > self.max_tokens_per_minute:
+                    logging.error( f"Request {index} needs about {tokens} tokens, more than the "
+                                   f"{self.max_tokens_per_minute:g} tokens-per-minute limit." )
+                elif attempt + 1 < self.max_attempts:
+                    await asyncio.sleep( RETRY_BACKOFF_SECONDS * 2 ** attempt )
+                    queue.put_nowait( ( index, message, cache_key, tokens, attempt + 1 ) )
+                else:
+                    logging.error( f"Request {index} rate limited after {self.max_attempts} attempts." )
+            except APIError as error:
+                logging.error( f"Request {index} failed: {error}" )
+            except Exception as error:
+                # Keep the worker alive; a dead worker would leave queue.join( ) waiting forever.
+                logging.error( f"Request {index} failed: {error!r}" )
+            finally:
+                queue.task_done( )
+
+    async def run( self, messages: list[Optional[PromptMessage]],
+                   cache_keys: Optional[list[Optional[str]]] = None ) -> list[Optional[str]]:
+        """Executes the messages and returns the responses in the same order."""
+        import asyncio
+
+        results: list[Optional[str]] = [ None ] * len( messages )
+        queue: asyncio.Queue = asyncio.Queue( )
+        for index, message in enumerate( messages ):
+            if not message:
+                continue
+            cache_key = cache_keys[index] if cache_keys else None
+            queue.put_nowait( ( index, message, cache_key, self.estimate_tokens( message ), 0 ) )
+
+        workers = [ asyncio.create_task( self._worker( queue, results ) )
+                    for _ in range( self.num_workers ) ]
+        await queue.join( )
+        for worker in workers:
+            worker.cancel( )
+        await asyncio.gather( *workers, return_exceptions = True )
+
+        return results
+
+
+class BatchRunner():
+    """Runs prompts through the OpenAI Batch API (24h turnaround, discounted pricing)."""
+
+    def __init__( self, llm_client: OpenAIClient, poll_interval: float = BATCH_POLL_SECONDS ):
+        """Initializes the runner with the client used to upload and poll the batch."""
+        self.llm_client = llm_client
+        self.poll_interval = poll_interval
+
+    def serialize_requests( self, messages: dict[str, PromptMessage] ) -> bytes:
+        """Serializes the messages, keyed by custom id, into a Batch API JSONL file."""
+        lines = [ json_dumps( { "custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT,
+                                "body": self.llm_client.build_request_body( message ) } )
+                  for custom_id, message in messages.items( ) ]
+        return b"\n".join( lines ) + b"\n"
+
+    @staticmethod
+    def parse_responses( content: str ) -> dict[str, str]:
+        """Parses a Batch API output or error file into response text keyed by custom id.
+
+        Failed requests are logged and left out.
+        """
+        responses = { }
+        for line in content.splitlines( ):
+            if not line.strip( ):
+                continue
+            record = json_loads( line )
+            response = record.get( "response" ) or { }
+            if response.get( "status_code" ) != 200:
+                error = record.get( "error" ) or ( response.get( "body" ) or { } ).get( "error" )
+                logging.error( f"Batch request {record.get( 'custom_id' )} failed: {error}" )
+                continue
+            choice = response["body"]["choices"][0]
+            # Refusals and content filters come back without any content.
+            if choice["message"].get( "content" ) is None:
+                logging.error( f"Batch request {record['custom_id']} has no content "
+                               f"(finish reason: {choice.get( 'finish_reason' )})." )
+                continue
+            responses[record["custom_id"]] = choice["message"]["content"].strip( )
+        return responses
+
+    async def _wait_for_batch( self, batch ):
+        """Polls the batch until it reaches a final state, riding out transient API errors."""
+        import asyncio
+        from openai import APIConnectionError, InternalServerError, RateLimitError
+
+        client = self.llm_client.client
+        while batch.status not in BATCH_FINAL_STATES:
+            await asyncio.sleep( self.poll_interval )
+            try:
+                batch = await client.batches.retrieve( batch.id )
+            except ( APIConnectionError, InternalServerError, RateLimitError ) as error:
+                logging.warning( f"Unable to poll batch {batch.id}, retrying: {error}" )
+        return batch
+
+    async def run( self, messages: list[Optional[PromptMessage]] ) -> list[Optional[str]]:
+        """Submits the messages as one batch, waits for it to finish and returns the responses in order."""
+        from openai import APIError
+
+        client = self.llm_client.client
+        requests = { f"request-{index}": message for index, message in enumerate( messages ) if message }
+        results: list[Optional[str]] = [ None ] * len( messages )
+        if not requests:
+            return results
+
+        try:
+            batch_file = await client.files.create( file = ( "codeaid_batch.jsonl", self.serialize_requests( requests ) ),
+                                                    purpose = "batch" )
+            batch = await client.batches.create( input_file_id = batch_file.id, endpoint = BATCH_ENDPOINT,
+                                                 completion_window = "24h" )
+        except APIError as error:
+            logging.error( f"Unable to submit batch: {error}" )
+            return results
+        print( f"Submitted batch {batch.id}, waiting for completion...", file = sys.stderr )
+
+        batch = await self._wait_for_batch( batch )
+        if batch.status != "completed":
+            logging.error( f"Batch {batch.id} finished with status {batch.status}." )
+            return results
+
+        # Successful requests are written to the output file and failed ones to the error file.
+        responses = { }
+        for file_id in ( batch.output_file_id, batch.error_file_id ):
+            if file_id is None:
+                continue
+            try:
+                content = await client.files.content( file_id )
+            except APIError as error:
+                logging.error( f"Unable to download the results of batch {batch.id} ({file_id}): {error}" )
+                continue
+            responses.update( self.parse_responses( content.text ) )
+        for index in range( len( messages ) ):
+            results[index] = responses.get( f"request-{index}" )
+        return results
+
+
+class SourceFile():
+    """Raw bytes of a source file, hashed on read and decoded only on demand."""
+
+    def __init__( self, data ):
+        """Initializes the source from bytes or a memory map."""
+        self._data = data
+        self.size = len( data )
+        self.digest = hashlib.blake2b( data ).hexdigest( )
+
+    def text( self ) -> str:
+        """Decodes the source as UTF-8, replacing any undecodable bytes."""
+        # Decodes straight from the buffer, without copying a memory map into bytes first.
+        return str( self._data, "utf-8", "replace" )
+
+    def close( self ) -> None:
+        """Releases the memory map, if the source was mapped."""
+        if isinstance( self._data, mmap.mmap ):
+            self._data.close( )
+
+
+def read_source_file( filename: str) -> Optional[SourceFile]:
+    """Reads the content of the source file and returns to the caller.
+
+    Files above MMAP_THRESHOLD are memory-mapped rather than copied into memory.
+    """
     try:
-        with open(filename, "r") as file:
-            return file.read( )
+        with open(filename, "rb") as file:
+            if os.fstat( file.fileno( ) ).st_size > MMAP_THRESHOLD:
+                return SourceFile( mmap.mmap( file.fileno( ), 0, access = mmap.ACCESS_READ ) )
+            return SourceFile( file.read( ) )
     except FileNotFoundError:
         logging.error(f'Source filename ({filename}) not found.')
         return None
+    except OSError as error:
+        # A directory or unreadable file skips just that file, not the whole run.
+        logging.error(f'Unable to read source filename ({filename}): {error}')
+        return None
+
+
+def _python_boundaries( source: str ) -> Optional[list[int]]:
+    """Returns the line indices where top-level Python statements start, or None if unparsable."""
+    try:
+        tree = ast.parse( source )
+    except ( SyntaxError, ValueError ):
+        return None
+    starts = { min( [ node.lineno ] + [ decorator.lineno for decorator in getattr( node, "decorator_list", [ ] ) ] ) - 1
+               for node in tree.body }
+    return sorted( start for start in starts if start > 0 )
+
+
+def _split_by_tokens( text: str, max_tokens: int ) -> list[str]:
+    """Splits text into pieces of at most max_tokens, regardless of its structure."""
+    encoding = _get_encoding( )
+    if encoding is None:
+        # Mirrors the length-based estimate in count_tokens.
+        step = max( 1, ( max_tokens - 1 ) * 4 )
+        return [ text[start:start + step] for start in range( 0, len( text ), step ) ]
+    tokens = encoding.encode( text, disallowed_special = ( ) )
+    return [ encoding.decode( tokens[start:start + max_tokens] )
+             for start in range( 0, len( tokens ), max_tokens ) ]
+
+
+def _pack_units( units: list[str], max_tokens: int ) -> list[str]:
+    """Greedily packs consecutive units into chunks of at most max_tokens.
+
+    A unit that is too large on its own is packed line by line instead, and
+    a single line that is too large (e.g. minified code) is cut by token count.
+    """
+    chunks, current, current_tokens = [ ], "", 0
+    for unit in units:
+        tokens = count_tokens( unit )
+        if tokens > max_tokens:
+            if current:
+                chunks.append( current )
+                current, current_tokens = "", 0
+            lines = unit.splitlines( keepends = True )
+            if len( lines ) > 1:
+                chunks.extend( _pack_units( lines, max_tokens ) )
+            else:
+                chunks.extend( _split_by_tokens( unit, max_tokens ) )
+            continue
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append( current )
+            current, current_tokens = "", 0
+        current += unit
+        current_tokens += tokens
+    if current:
+        chunks.append( current )
+    return chunks
+
+
+def split_source( source: str, filename: str, max_tokens: int ) -> list[str]:
+    """Splits the source into chunks of at most max_tokens.
+
+    Python sources are split between top-level definitions, anything else
+    (or Python that does not parse) after blank lines.
+    """
+    lines = source.splitlines( keepends = True )
+    boundaries = _python_boundaries( source ) if filename.endswith( ".py" ) else None
+    if boundaries is None:
+        boundaries = [ index for index in range( 1, len( lines ) ) if not lines[index - 1].strip( ) ]
+    units = [ "".join( lines[start:end] )
+              for start, end in zip( [ 0 ] + boundaries, boundaries + [ len( lines ) ] ) ]
+    return _pack_units( units, max_tokens )
 
 
 def print_usage_instructions( prompt_manager: PromptManager ) -> None:
     """Displays usage instructions for the script."""
-    print( "Usage is:\n\n\tasst.py --goal <goal> --filename <filename> --target <language>" )
-    print( f"\t\tWhere goal is: [{ prompt_manager.goals( ) } ]" )
-    print( "\t\tand <filename> is the source file to analyze, <language> is the target language for translate.\n" )
+    print( "Usage is:\n\n\tasst.py --goal <goal> --file <filename> [--file <filename> ...] --target <language>" )
+    print( f"\t\tWhere goal is: [{ prompt_manager.goals } ]" )
+    print( "\t\tand <filename> is a source file to analyze, <language> is the target language for translate.\n" )
+
+
+def positive_float( value: str ) -> float:
+    """Parses a command-line value that must be a number greater than zero."""
+    try:
+        number = float( value )
+    except ValueError:
+        raise argparse.ArgumentTypeError( f"invalid number: '{value}'" )
+    if not number > 0:
+        raise argparse.ArgumentTypeError( f"must be greater than zero: '{value}'" )
+    return number
 
 
 def parse_arguments() -> argparse.Namespace:
@@ -195,16 +922,35 @@ def parse_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser( description='Analyze source files using a given goal.' )
     parser.add_argument( '--goal', default=None,
                          help='Analysis goal (--show-goals to review)' )
-    parser.add_argument( '--file', default=None,
-                         dest='filename', help='The source filename for analysis' )
+    parser.add_argument( '--file', default=None, action='append',
+                         dest='filenames', help='A source filename for analysis (may be repeated)' )
     parser.add_argument( '--target', default=None,
                          dest='target', help='The target language for translate.')
+    parser.add_argument( '--temperature', type=float, default=DEFAULT_TEMPERATURE,
+                         help='Sampling temperature; any value other than 0 disables caching.' )
+    parser.add_argument( '--no-cache', action='store_true',
+                         help='Always query the API instead of reusing cached responses.' )
+    parser.add_argument( '--cache-ttl', type=float, default=DEFAULT_CACHE_TTL,
+                         help=f'Seconds a cached response stays valid (default {DEFAULT_CACHE_TTL}).' )
+    parser.add_argument( '--semantic-threshold', type=float, nargs='?', default=None,
+                         const=DEFAULT_SEMANTIC_THRESHOLD,
+                         help='Reuse responses for prompts whose embeddings exceed this cosine '
+                              f'similarity to a cached prompt (default {DEFAULT_SEMANTIC_THRESHOLD}).' )
+    parser.add_argument( '--max-requests-per-minute', type=positive_float, default=MAX_REQUESTS_PER_MINUTE,
+                         help=f'Request rate limit of your OpenAI account (default {MAX_REQUESTS_PER_MINUTE}).' )
+    parser.add_argument( '--max-tokens-per-minute', type=positive_float, default=MAX_TOKENS_PER_MINUTE,
+                         help=f'Token rate limit of your OpenAI account (default {MAX_TOKENS_PER_MINUTE}).' )
+    dispatch = parser.add_mutually_exclusive_group( )
+    dispatch.add_argument( '--combine', action='store_true',
+                           help='Send all files in a single request instead of one request per file.' )
+    dispatch.add_argument( '--batch', action='store_true',
+                           help='Submit the files through the OpenAI Batch API (up to 24h, half price).' )
     return parser.parse_args( )
 
 
-def create_prompt_manager( goal, filename, target ) -> PromptManager:
+def create_prompt_manager( goal, filenames, target ) -> PromptManager:
     prompt_manager = PromptManager( )
-    if goal is None or filename is None:
+    if goal is None or not filenames:
         print_usage_instructions( prompt_manager )
         sys.exit( 1 )
     if goal == 'translate' and target is None:
@@ -214,21 +960,268 @@ def create_prompt_manager( goal, filename, target ) -> PromptManager:
     return prompt_manager
 
 
+async def combine_prompts( llm_client: OpenAIClient, prompts: list[Optional[PromptMessage]] ) -> list[Optional[str]]:
+    """Sends the valid prompts in as few requests as fit the request size limit and maps the answers back."""
+    limit = llm_client.max_request_tokens
+    groups, group, group_tokens = [ ], [ ], 0
+    for index, prompt in enumerate( prompts ):
+        if not prompt:
+            continue
+        # Counting each prompt's system message over-estimates a group, leaving room for the task headers.
+        tokens = ParallelProcessor.estimate_tokens( prompt )
+        if group and group_tokens + tokens > limit:
+            groups.append( group )
+            group, group_tokens = [ ], 0
+        group.append( index )
+        group_tokens += tokens
+    if group:
+        groups.append( group )
+
+    # Each group may use the whole token budget, so the groups are paced like single prompts.
+    combined = [ llm_client.compose_batched_message( [ prompts[index] for index in indices ] ) for indices in groups ]
+    responses = await ParallelProcessor( llm_client ).run( combined )
+
+    results: list[Optional[str]] = [ None ] * len( prompts )
+    for indices, response in zip( groups, responses ):
+        if response is None:
+            logging.error( f"Combined request for {len( indices )} files failed." )
+            continue
+        answers = llm_client.split_batched_response( response, len( indices ) )
+        for task, ( index, answer ) in enumerate( zip( indices, answers ), start = 1 ):
+            if answer is None:
+                logging.error( f"Combined response is missing task {task}." )
+            results[index] = answer
+    return results
+
+
+def _group_analyses( system: str, analyses: list[str], max_tokens: int ) -> list[list[str]]:
+    """Groups consecutive analyses into reduce prompts of at most max_tokens each."""
+    budget = max_tokens - count_tokens( f"{REDUCE_PROMPT}\n{system}" )
+    groups, group, group_tokens = [ ], [ ], 0
+    for analysis in analyses:
+        tokens = count_tokens( analysis ) + PART_HEADER_TOKENS
+        if group and group_tokens + tokens > budget:
+            groups.append( group )
+            group, group_tokens = [ ], 0
+        group.append( analysis )
+        group_tokens += tokens
+    if group:
+        groups.append( group )
+    return groups
+
+
+async def reduce_in_stages( llm_client: OpenAIClient, oversize: dict[int, tuple[str, PromptMessage]],
+                            analyses: dict[int, list[str]] ) -> tuple[dict[int, list[str]], dict[int, str]]:
+    """Merges groups of analyses until each file's analyses fit in one reduce prompt.
+
+    Returns the analyses ready for the final reduce, and the joined analyses
+    of files that could not be merged further.
+    """
+    limit = llm_client.max_request_tokens
+    pending, joined = dict( analyses ), { }
+    while True:
+        # Per file, the merged analyses of this stage: a prompt position, or an analysis left as is.
+        stages: dict[int, list] = { }
+        prompts = [ ]
+        for index, parts in list( pending.items( ) ):
+            system = oversize[index][1][0]
+            if ParallelProcessor.estimate_tokens( llm_client.compose_reduce_message( system, parts ) ) <= limit:
+                continue
+            groups = _group_analyses( system, parts, limit )
+            if len( groups ) == len( parts ):
+                # Each analysis fills a request on its own, so merging can make no progress.
+                logging.warning( f"The analyses of {oversize[index][0]} are too large to merge; joining them in order." )
+                joined[index] = "\n\n".join( pending.pop( index ) )
+                continue
+            stages[index] = [ ]
+            for group in groups:
+                if len( group ) == 1:
+                    stages[index].append( group[0] )
+                else:
+                    stages[index].append( len( prompts ) )
+                    prompts.append( llm_client.compose_reduce_message( system, group ) )
+        if not prompts:
+            return pending, joined
+
+        merged = await ParallelProcessor( llm_client, use_semantic_cache = False ).run( prompts )
+        for index, stage in stages.items( ):
+            parts = [ merged[part] if isinstance( part, int ) else part for part in stage ]
+            if None in parts:
+                logging.error( f"Unable to merge the analyses of {oversize[index][0]}." )
+                del pending[index]
+            else:
+                pending[index] = parts
+
+
+async def map_reduce_files( llm_client: OpenAIClient, goal: str, oversize: dict[int, tuple[str, PromptMessage]],
+                            cache_keys: list[Optional[str]], output: Optional[TextIO] ) -> dict[int, Optional[str]]:
+    """Analyzes sources too large for one request chunk by chunk, then merges the analyses.
+
+    oversize maps a file index to its filename and full prompt message.
+    """
+    chunk_prompts, owners = [ ], [ ]
+    for index, ( filename, ( system, source ) ) in oversize.items( ):
+        label = f"[Part 0000 of 0000 of {os.path.basename( filename )}]\n"
+        budget = min( CHUNK_TOKENS, llm_client.max_request_tokens ) - count_tokens( system ) - count_tokens( label )
+        if budget < 1:
+            logging.error( f"The {llm_client.max_request_tokens}-token request limit leaves no room for "
+                           f"the source of {filename}." )
+            continue
+        chunks = split_source( source, filename, budget )
+        for part, chunk in enumerate( chunks, start = 1 ):
+            chunk_prompts.append( ( system, f"[Part {part} of {len( chunks )} of {os.path.basename( filename )}]\n{chunk}" ) )
+            owners.append( index )
+
+    analyses = await ParallelProcessor( llm_client ).run( chunk_prompts )
+
+    results: dict[int, Optional[str]] = dict.fromkeys( oversize )
+    pending: dict[int, list[str]] = { }
+    for index in oversize:
+        parts = [ analysis for analysis, owner in zip( analyses, owners ) if owner == index ]
+        if None in parts:
+            logging.error( f"Unable to analyze every part of {oversize[index][0]}." )
+        elif parts:
+            pending[index] = parts
+
+    if goal in REWRITE_GOALS:
+        # Merging rewritten code would take a prompt as large as the source itself.
+        pending, joined = { }, { index: "\n\n".join( parts ) for index, parts in pending.items( ) }
+    else:
+        pending, joined = await reduce_in_stages( llm_client, oversize, pending )
+
+    for index, response in joined.items( ):
+        results[index] = response
+        write_response( output, response )
+        if llm_client.cache.enabled:
+            llm_client.cache.put( cache_keys[index], response )
+
+    # The reduce prompts hold analyses rather than source, so they stay out of the semantic cache.
+    indices = list( pending )
+    reduce_prompts = [ llm_client.compose_reduce_message( oversize[index][1][0], pending[index] ) for index in indices ]
+    merged = await ParallelProcessor( llm_client, output = output, use_semantic_cache = False ).run(
+        reduce_prompts, [ cache_keys[index] for index in indices ] )
+    results.update( zip( indices, merged ) )
+    return results
+
+
+async def analyze_files( prompt_manager: PromptManager, args: argparse.Namespace, openai_key: str,
+                         output: Optional[TextIO] = None ) -> list[Optional[str]]:
+    """Dispatches the goal concurrently across all requested source files.
+
+    Responses are streamed to the output if one is given.
+    """
+    cache = ResponseCache( ttl = args.cache_ttl, enabled = not args.no_cache )
+    if args.temperature != 0 and cache.enabled:
+        logging.warning( f"Caching is disabled at non-zero temperature ({args.temperature})." )
+        cache.enabled = False
+    llm_client = OpenAIClient( openai_key, cache, args.temperature,
+                               args.max_requests_per_minute, args.max_tokens_per_minute )
+    # The goal's prompt with an empty source: it scopes the semantic cache and keys the exact one.
+    template = llm_client.compose_prompt_message( args.goal, "", prompt_manager, args.target )
+    if template is None:
+        await llm_client.close( )
+        return [ None ] * len( args.filenames )
+
+    if args.semantic_threshold is not None and cache.enabled:
+        try:
+            llm_client.semantic_cache = SemanticCache( llm_client.client, template[0],
+                                                       threshold = args.semantic_threshold, ttl = args.cache_ttl )
+        except ImportError:
+            logging.error( "The semantic cache requires the faiss and numpy packages." )
+
+    try:
+        return await dispatch_files( llm_client, prompt_manager, args, template, output )
+    finally:
+        await llm_client.close( )
+
+
+async def dispatch_files( llm_client: OpenAIClient, prompt_manager: PromptManager, args: argparse.Namespace,
+                          template: PromptMessage, output: Optional[TextIO] ) -> list[Optional[str]]:
+    """Serves each file from the cache or sends it through the selected dispatch mode."""
+    cache = llm_client.cache
+    responses: list[Optional[str]] = [ None ] * len( args.filenames )
+    key_body = llm_client.build_request_body( template )
+    # The Batch API has no per-request token rate limit, so batched sources are bounded only by the context window.
+    limit = MODEL_CONTEXT_TOKENS - RESPONSE_TOKEN_RESERVE if args.batch else llm_client.max_request_tokens
+    prompts, cache_keys = [ ], [ ]
+    oversize: dict[int, tuple[str, PromptMessage]] = { }
+    for index, filename in enumerate( args.filenames ):
+        source = read_source_file( filename )
+        prompt, cache_key = None, None
+        if source is not None and source.size:
+            cache_key = ResponseCache.make_key( key_body, source.digest )
+            # Cache hits need neither the decoded source nor any API budget.
+            responses[index] = cache.get( cache_key ) if cache.enabled else None
+            if responses[index] is None:
+                prompt = llm_client.compose_prompt_message( args.goal, source.text( ), prompt_manager, args.target )
+                # Sources too large for one request are map-reduced over chunks instead.
+                if prompt and ParallelProcessor.estimate_tokens( prompt ) > limit:
+                    oversize[index] = ( filename, prompt )
+                    prompt = None
+            else:
+                write_response( output, responses[index] )
+        if source is not None:
+            source.close( )
+        prompts.append( prompt )
+        cache_keys.append( cache_key )
+
+    if args.batch:
+        fresh = await BatchRunner( llm_client ).run( prompts )
+    elif args.combine:
+        fresh = await combine_prompts( llm_client, prompts )
+    else:
+        fresh = await ParallelProcessor( llm_client, output = output ).run( prompts, cache_keys )
+
+    for index, response in enumerate( fresh ):
+        if response is None:
+            continue
+        responses[index] = response
+        # execute_prompt caches its own responses; batched answers are stored here.
+        if ( args.batch or args.combine ) and cache.enabled:
+            cache.put( cache_keys[index], response )
+
+    if oversize:
+        for index, response in ( await map_reduce_files( llm_client, args.goal, oversize, cache_keys, output ) ).items( ):
+            responses[index] = response
+
+    if llm_client.semantic_cache is not None:
+        llm_client.semantic_cache.save( )
+    return responses
+
+
+def _assert_env( ) -> str:
+    """Returns the OPENAI Key from the environment variables, exiting if it is not set."""
+    openai_key = os.environ.get( 'OPENAI_KEY', None )
+    if openai_key is None:
+        logging.error( "OPENAI_KEY is not set\n" )
+        sys.exit(1)
+    return openai_key
+
+
 def main( ) -> None:
     """Main function for script execution."""
     args = parse_arguments( )
 
-    prompt_manager = create_prompt_manager( args.goal, args.filename, args.target )
+    prompt_manager = create_prompt_manager( args.goal, args.filenames, args.target )
+
+    # Fail on a missing key before reading any source files.
+    openai_key = _assert_env( )
+
+    # asyncio is slow to load, so it is imported only once the arguments are known to be usable.
+    import asyncio
+
+    # A single file is streamed as it is generated; concurrent responses would interleave.
+    if len( args.filenames ) == 1 and not ( args.batch or args.combine ):
+        asyncio.run( analyze_files( prompt_manager, args, openai_key, sys.stdout ) )
+        return
 
-    source = read_source_file( args.filename )
+    responses = asyncio.run( analyze_files( prompt_manager, args, openai_key ) )
 
-    if source:
-        llm_client = OpenAIClient( )
-        prompt = llm_client.compose_prompt_message( args.goal, source, prompt_manager, args.target )
-        if prompt:
-            response = llm_client.execute_prompt( prompt )
-            if response:
-                print( response  )
+    for filename, response in zip( args.filenames, responses ):
+        if response:
+            if len( args.filenames ) > 1:
+                print( f"==> {filename} <==" )
+            print( response )
 
 
 if __name__ == "__main__":